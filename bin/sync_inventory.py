@@ -5,6 +5,7 @@ import sys
 import json
 import logging
 import time
+import argparse
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 from typing import Dict, Any
@@ -13,6 +14,8 @@ from typing import Dict, Any
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from lib.veeam_client import VeeamClient
 from lib.cmdb_client import CMDBuildClient
+from lib.sync_pipeline import SyncPipeline
+from lib.profiling import Profiler, span
 
 def setup_logging(config: Dict[str, Any]) -> None:
     """Configura il sistema di logging"""
@@ -40,6 +43,32 @@ def setup_logging(config: Dict[str, Any]) -> None:
     root_logger.setLevel(log_config.get('level', 'INFO'))
     root_logger.addHandler(handler)
 
+def parse_args(argv=None) -> argparse.Namespace:
+    """Interpreta gli argomenti da riga di comando"""
+    parser = argparse.ArgumentParser(
+        description="Sincronizza l'inventario Veeam con CMDBuild"
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='TRACE_FILE',
+        help="Profila l'esecuzione e salva il trace (formato Trace Event JSON) in TRACE_FILE"
+    )
+    parser.add_argument(
+        '--profile-cprofile',
+        action='store_true',
+        help="Con --profile, salva anche le statistiche cProfile in un file .pstats accanto al trace"
+    )
+    parser.add_argument(
+        '--backfill-origin',
+        choices=['dry-run', 'apply'],
+        help="Marca con Origin i server creati dal connettore prima dell'introduzione "
+             "dell'attributo ed esce senza sincronizzare"
+    )
+    args = parser.parse_args(argv)
+    if args.profile_cprofile and not args.profile:
+        parser.error("--profile-cprofile richiede --profile")
+    return args
+
 def load_config() -> Dict[str, Any]:
     """Carica la configurazione dal file JSON"""
     config_path = os.path.join(
@@ -92,11 +121,23 @@ def sync_inventory(veeam_client: VeeamClient, cmdb_client: CMDBuildClient, confi
         config: Configurazione del connettore
     """
     try:
-        # Recupera l'inventario da Veeam
-        inventory = veeam_client.get_full_inventory()
+        pipeline_config = config.get('sync', {}).get('pipeline', {})
         
-        # Sincronizza con CMDBuild
-        cmdb_client.sync_veeam_inventory(inventory)
+        if pipeline_config.get('enabled', False):
+            # Raccolta Veeam e scrittura CMDBuild sovrapposte tramite coda limitata
+            with span("sync_inventory", mode="pipeline"):
+                SyncPipeline(
+                    veeam_client,
+                    cmdb_client,
+                    pipeline_config.get('queue_size', 10)
+                ).run()
+        else:
+            with span("sync_inventory", mode="sequential"):
+                # Recupera l'inventario da Veeam
+                inventory = veeam_client.get_full_inventory()
+                
+                # Sincronizza con CMDBuild
+                cmdb_client.sync_veeam_inventory(inventory)
         
         logging.info("Sincronizzazione completata con successo")
         
@@ -105,6 +146,9 @@ def sync_inventory(veeam_client: VeeamClient, cmdb_client: CMDBuildClient, confi
         raise
 
 def main():
+    args = parse_args()
+    profiler = None
+    
     try:
         # Carica la configurazione
         config = load_config()
@@ -114,10 +158,20 @@ def main():
         
         logging.info("Avvio sincronizzazione Veeam con CMDBuild")
         
+        if args.profile:
+            profiler = Profiler(cprofile=args.profile_cprofile)
+            profiler.start()
+        
         # Inizializza i client
         veeam_client = VeeamClient(config)
         cmdb_client = CMDBuildClient(config)
         
+        if args.backfill_origin:
+            # Migrazione una tantum, senza sincronizzazione
+            cmdb_client.backfill_origin(apply=args.backfill_origin == 'apply')
+            logging.info("Backfill dell'attributo Origin completato")
+            return
+        
         # Configurazione retry
         retry_config = config['veeam'].get('retry', {})
         max_attempts = retry_config.get('max_attempts', 3)
@@ -130,11 +184,27 @@ def main():
             retry_delay
         )
         
+        # Riconcilia le card non più presenti in Veeam, fuori dal retry: un
+        # inventario sospetto fa fallire l'esecuzione senza ripetere la sincronizzazione
+        reconcile_config = config.get('sync', {}).get('reconcile', {})
+        
+        if reconcile_config.get('enabled', False):
+            with span("reconcile"):
+                cmdb_client.reconcile_stale_cards(
+                    reconcile_config.get('max_stale_ratio', 0.2),
+                    reconcile_config.get('min_stale_count', 5),
+                    reconcile_config.get('inactive_status', 'N')
+                )
+        
         logging.info("Processo di sincronizzazione completato con successo")
         
     except Exception as e:
         logging.error(f"Errore fatale durante l'esecuzione: {str(e)}")
         sys.exit(1)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.write(args.profile)
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,25 @@
+import json
 import requests
 import logging
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Set
 from datetime import datetime
+from collections import defaultdict
 from .cmdb_schema import (
     get_class_schema,
     get_key_attribute,
+    get_status_attribute,
+    get_sync_tags,
+    get_asset_attributes,
+    is_owned_by_sync,
     validate_data,
-    get_domains
+    get_domains,
+    SYNC_ORIGIN
 )
+from .profiling import span
+
+class ReconcileError(Exception):
+    """Riconciliazione annullata o incompleta per inventario sospetto"""
+
 
 class CMDBuildClient:
     """Client per le API REST di CMDBuild"""
@@ -21,6 +33,12 @@ class CMDBuildClient:
         self.infrastructure_code = config.get('infrastructure_code', 'VEEAM-BACKUP')
         self.token = None
         self.session = requests.Session()
+        # Codici sincronizzati nell'esecuzione corrente, per classe
+        self.synced_codes: Dict[str, Set[str]] = defaultdict(set)
+        # Job le cui VM non sono state recuperate completamente
+        self.incomplete_jobs: Set[str] = set()
+        # SyncStatus viene scritto solo se la riconciliazione è abilitata
+        self.reconcile_enabled = config.get('sync', {}).get('reconcile', {}).get('enabled', False)
         
     def authenticate(self) -> None:
         """Esegue l'autenticazione su CMDBuild"""
@@ -47,15 +65,17 @@ class CMDBuildClient:
         url = f"{self.base_url}/{endpoint}"
         
         try:
-            response = self.session.request(
-                method=method,
-                url=url,
-                json=data,
-                params=params,
-                verify=self.verify_ssl
-            )
+            with span("cmdb.request", cat="network", method=method, endpoint=endpoint):
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    json=data,
+                    params=params,
+                    verify=self.verify_ssl
+                )
             response.raise_for_status()
-            return response.json()
+            with span("cmdb.json", cat="json", endpoint=endpoint):
+                return response.json()
         except requests.exceptions.RequestException as e:
             logging.error(f"Errore nella richiesta API CMDBuild {endpoint}: {str(e)}")
             raise
@@ -120,7 +140,8 @@ class CMDBuildClient:
         """Crea o aggiorna una card"""
         try:
             # Valida i dati contro lo schema
-            validate_data(class_name, data)
+            with span("cmdb.validate", cat="validation", class_name=class_name):
+                validate_data(class_name, data)
             
             # Cerca la card esistente
             key_attr = get_key_attribute(class_name)
@@ -135,11 +156,11 @@ class CMDBuildClient:
                     data=data
                 )["data"]
             else:
-                # Crea nuova card
+                # Crea nuova card, marcandola come creata dal connettore
                 return self._make_request(
                     f"classes/{class_name}/cards",
                     method="POST",
-                    data=data
+                    data={**data, "Origin": SYNC_ORIGIN}
                 )["data"]
         except Exception as e:
             logging.error(f"Errore nella creazione/aggiornamento della card {class_name}: {str(e)}")
@@ -166,138 +187,364 @@ class CMDBuildClient:
             logging.error(f"Errore nella creazione della relazione {domain_name}: {str(e)}")
             raise
 
+    def reset_sync_tracking(self) -> None:
+        """Azzera i codici e i job tracciati per la riconciliazione"""
+        self.synced_codes.clear()
+        self.incomplete_jobs.clear()
+
+    def sync_proxy(self, infra_id: int, proxy: Dict) -> Dict:
+        """Sincronizza un proxy Veeam cercandolo tra gli asset esistenti"""
+        # Prima cerca il proxy tra i VirtualServer
+        proxy_vm = self.find_card_by_code("VirtualServer", proxy["id"])
+        
+        if proxy_vm:
+            logging.info(f"Proxy {proxy['id']} trovato come VirtualServer esistente")
+            # Aggiorna solo gli attributi Veeam-specifici
+            proxy_data = {
+                "_id": proxy_vm["_id"],
+                "Type": "VeeamProxy",
+                "Status": "A",
+                "LastUpdate": datetime.now().isoformat()
+            }
+            proxy_card = self.create_or_update_card("VirtualServer", proxy_data)
+            server_type = "VirtualServer"
+        else:
+            # Se non trovato come VM, cerca tra i PhysicalServer
+            proxy_physical = self.find_card_by_code("PhysicalServer", proxy["id"])
+            
+            if proxy_physical:
+                logging.info(f"Proxy {proxy['id']} trovato come PhysicalServer esistente")
+                proxy_data = {
+                    "_id": proxy_physical["_id"],
+                    "Type": "VeeamProxy",
+                    "Status": "A",
+                    "LastUpdate": datetime.now().isoformat()
+                }
+                proxy_card = self.create_or_update_card("PhysicalServer", proxy_data)
+                server_type = "PhysicalServer"
+            else:
+                # Se non trovato da nessuna parte, crea un nuovo PhysicalServer
+                logging.warning(f"Proxy {proxy['id']} non trovato in asset, creazione nuovo PhysicalServer")
+                proxy_data = {
+                    "Code": proxy["id"],
+                    "Hostname": proxy.get("name", ""),
+                    "Type": "VeeamProxy",
+                    "Status": "A",
+                    "OS": proxy.get("os", ""),
+                    "OSVersion": proxy.get("osVersion", ""),
+                    "LastUpdate": datetime.now().isoformat()
+                }
+                proxy_card = self.create_or_update_card("PhysicalServer", proxy_data)
+                server_type = "PhysicalServer"
+        self.synced_codes[server_type].add(proxy["id"])
+        
+        # Crea relazione con l'infrastruttura
+        self.create_relation(
+            "InfrastructureCI",
+            "Infrastructure",
+            infra_id,
+            server_type,
+            proxy_card["_id"]
+        )
+        return proxy_card
+
+    def sync_repository(self, infra_id: int, repo: Dict) -> Dict:
+        """Sincronizza un repository Veeam come Storage"""
+        repo_data = {
+            "Code": repo["id"],
+            "Name": repo.get("name", ""),
+            "Type": "VeeamRepository",
+            "Capacity": repo.get("capacity", 0),
+            "FreeSpace": repo.get("freeSpace", 0),
+            "Status": "A"
+        }
+        repo_card = self.create_or_update_card("Storage", repo_data)
+        self.synced_codes["Storage"].add(repo["id"])
+        
+        # Crea relazione con l'infrastruttura
+        self.create_relation(
+            "InfrastructureCI",
+            "Infrastructure",
+            infra_id,
+            "Storage",
+            repo_card["_id"]
+        )
+        return repo_card
+
+    def sync_backup_job(self, infra_id: int, job: Dict) -> Dict:
+        """Sincronizza un backup job e le VM associate"""
+        with span("sync.backup_job", job=job["id"]):
+            # Crea il job
+            job_data = {
+                "Code": job["id"],
+                "Name": job.get("name", ""),
+                "Type": "VeeamBackup",
+                "Status": job.get("status", "Unknown"),
+                "LastRun": job.get("lastRun", ""),
+                "NextRun": job.get("nextRun", ""),
+                "Repository": job.get("repositoryId", "")
+            }
+            if self.reconcile_enabled:
+                job_data["SyncStatus"] = "A"
+            job_card = self.create_or_update_card("BackupJob", job_data)
+            self.synced_codes["BackupJob"].add(job["id"])
+            if job.get("vmsIncomplete"):
+                self.incomplete_jobs.add(job["id"])
+            
+            # Crea relazione con il repository
+            if job.get("repositoryId"):
+                repo = self.find_card_by_code("Storage", job["repositoryId"])
+                if repo:
+                    self.create_relation(
+                        "CIDependency",
+                        "BackupJob",
+                        job_card["_id"],
+                        "Storage",
+                        repo["_id"]
+                    )
+            
+            # Sincronizza VM del job
+            for vm in job.get("vms", []):
+                vm_data = {
+                    "Code": vm["id"],
+                    "Hostname": vm.get("name", ""),
+                    "Status": "A",
+                    "LastBackup": vm.get("lastBackup", ""),
+                    "BackupJob": job["id"]
+                }
+                vm_card = self.create_or_update_card("VirtualServer", vm_data)
+                self.synced_codes["VirtualServer"].add(vm["id"])
+            
+                # Crea relazione con l'infrastruttura
+                self.create_relation(
+                    "InfrastructureCI",
+                    "Infrastructure",
+                    infra_id,
+                    "VirtualServer",
+                    vm_card["_id"]
+                )
+        return job_card
+
     def sync_veeam_inventory(self, inventory: Dict[str, List[Dict]]) -> None:
         """Sincronizza l'inventario Veeam con CMDBuild"""
         try:
             logging.info("Inizio sincronizzazione inventario Veeam")
+            self.reset_sync_tracking()
             
             # Recupera o crea l'infrastruttura
             infrastructure = self.get_infrastructure()
             infra_id = infrastructure["_id"]
             
             # Sincronizza Proxy
-            for proxy in inventory["proxies"]:
-                # Prima cerca il proxy tra i VirtualServer
-                proxy_vm = self.find_card_by_code("VirtualServer", proxy["id"])
-                
-                if proxy_vm:
-                    logging.info(f"Proxy {proxy['id']} trovato come VirtualServer esistente")
-                    # Aggiorna solo gli attributi Veeam-specifici
-                    proxy_data = {
-                        "_id": proxy_vm["_id"],
-                        "Type": "VeeamProxy",
-                        "Status": "A",
-                        "LastUpdate": datetime.now().isoformat()
-                    }
-                    proxy_card = self.create_or_update_card("VirtualServer", proxy_data)
-                    server_type = "VirtualServer"
-                else:
-                    # Se non trovato come VM, cerca tra i PhysicalServer
-                    proxy_physical = self.find_card_by_code("PhysicalServer", proxy["id"])
-                    
-                    if proxy_physical:
-                        logging.info(f"Proxy {proxy['id']} trovato come PhysicalServer esistente")
-                        proxy_data = {
-                            "_id": proxy_physical["_id"],
-                            "Type": "VeeamProxy",
-                            "Status": "A",
-                            "LastUpdate": datetime.now().isoformat()
-                        }
-                        proxy_card = self.create_or_update_card("PhysicalServer", proxy_data)
-                        server_type = "PhysicalServer"
-                    else:
-                        # Se non trovato da nessuna parte, crea un nuovo PhysicalServer
-                        logging.warning(f"Proxy {proxy['id']} non trovato in asset, creazione nuovo PhysicalServer")
-                        proxy_data = {
-                            "Code": proxy["id"],
-                            "Hostname": proxy.get("name", ""),
-                            "Type": "VeeamProxy",
-                            "Status": "A",
-                            "OS": proxy.get("os", ""),
-                            "OSVersion": proxy.get("osVersion", ""),
-                            "LastUpdate": datetime.now().isoformat()
-                        }
-                        proxy_card = self.create_or_update_card("PhysicalServer", proxy_data)
-                        server_type = "PhysicalServer"
-                
-                # Crea relazione con l'infrastruttura
-                self.create_relation(
-                    "InfrastructureCI",
-                    "Infrastructure",
-                    infra_id,
-                    server_type,
-                    proxy_card["_id"]
-                )
+            with span("sync.proxies"):
+                for proxy in inventory["proxies"]:
+                    self.sync_proxy(infra_id, proxy)
             
             # Sincronizza Repository
-            for repo in inventory["repositories"]:
-                repo_data = {
-                    "Code": repo["id"],
-                    "Name": repo.get("name", ""),
-                    "Type": "VeeamRepository",
-                    "Capacity": repo.get("capacity", 0),
-                    "FreeSpace": repo.get("freeSpace", 0),
-                    "Status": "A"
-                }
-                repo_card = self.create_or_update_card("Storage", repo_data)
-                
-                # Crea relazione con l'infrastruttura
-                self.create_relation(
-                    "InfrastructureCI",
-                    "Infrastructure",
-                    infra_id,
-                    "Storage",
-                    repo_card["_id"]
-                )
+            with span("sync.repositories"):
+                for repo in inventory["repositories"]:
+                    self.sync_repository(infra_id, repo)
             
             # Sincronizza Backup Jobs e VM
-            for job in inventory["backup_jobs"]:
-                # Crea il job
-                job_data = {
-                    "Code": job["id"],
-                    "Name": job.get("name", ""),
-                    "Type": "VeeamBackup",
-                    "Status": job.get("status", "Unknown"),
-                    "LastRun": job.get("lastRun", ""),
-                    "NextRun": job.get("nextRun", ""),
-                    "Repository": job.get("repositoryId", "")
-                }
-                job_card = self.create_or_update_card("BackupJob", job_data)
-                
-                # Crea relazione con il repository
-                if job.get("repositoryId"):
-                    repo = self.find_card_by_code("Storage", job["repositoryId"])
-                    if repo:
-                        self.create_relation(
-                            "CIDependency",
-                            "BackupJob",
-                            job_card["_id"],
-                            "Storage",
-                            repo["_id"]
+            with span("sync.backup_jobs"):
+                for job in inventory["backup_jobs"]:
+                    self.sync_backup_job(infra_id, job)
+            
+            logging.info("Sincronizzazione inventario Veeam completata con successo")
+            
+        except Exception as e:
+            logging.error(f"Errore durante la sincronizzazione dell'inventario: {str(e)}")
+            raise
+
+    def get_all_cards(self, class_name: str, attrs: List[str] = None, filter_query: Dict = None) -> List[Dict]:
+        """Recupera le card di una classe, a pagine di `sync.batch_size`, filtrate lato CMDBuild"""
+        batch_size = self.config.get('sync', {}).get('batch_size', 100)
+        params = {"limit": batch_size, "start": 0}
+        if attrs:
+            params["attrs"] = ",".join(attrs)
+        if filter_query:
+            params["filter"] = json.dumps(filter_query)
+        
+        cards = []
+        while True:
+            result = self._make_request(f"classes/{class_name}/cards", params=params)
+            cards.extend(result["data"])
+            total = result.get("meta", {}).get("total", len(cards))
+            if not result["data"] or len(cards) >= total:
+                return cards
+            params["start"] = len(cards)
+
+    def _sync_filter(self, class_name: str) -> Dict:
+        """Filtro CMDBuild sulle card marcate o create dal connettore"""
+        conditions = [
+            {"simple": {"attribute": "Origin", "operator": "equal", "value": [SYNC_ORIGIN]}}
+        ]
+        for attr, value in get_sync_tags(class_name).items():
+            if value is None:
+                conditions.append({"simple": {"attribute": attr, "operator": "isnotnull", "value": []}})
+            else:
+                conditions.append({"simple": {"attribute": attr, "operator": "equal", "value": [value]}})
+        return {"attribute": {"or": conditions}}
+
+    def get_sync_cards(self, class_name: str, attrs: List[str]) -> List[Dict]:
+        """Recupera le card marcate o create dal connettore per una classe"""
+        all_attrs = list(dict.fromkeys(["Code", "Origin", *get_sync_tags(class_name), *attrs]))
+        return self.get_all_cards(class_name, all_attrs, self._sync_filter(class_name))
+
+    def backfill_origin(self, apply: bool = False) -> Dict[str, List[str]]:
+        """
+        Marca con Origin i server creati dal connettore prima dell'introduzione dell'attributo
+        
+        Sono considerati creati dal connettore i server con marcatura Veeam e
+        senza alcun attributo compilato dall'asset management (es. Brand, Model
+        per i PhysicalServer). Storage e BackupJob non richiedono il backfill,
+        perché la loro marcatura basta a identificarli.
+        
+        Args:
+            apply: Se False elenca soltanto le card che verrebbero marcate
+            
+        Returns:
+            Codici individuati per classe
+        """
+        try:
+            found = {}
+            for class_name in ("PhysicalServer", "VirtualServer"):
+                asset_attrs = get_asset_attributes(class_name)
+                cards = [
+                    card for card in self.get_sync_cards(class_name, asset_attrs)
+                    if card.get("Origin") != SYNC_ORIGIN
+                    and get_sync_tags(class_name, card)
+                    and not any(card.get(attr) for attr in asset_attrs)
+                ]
+                for card in cards:
+                    logging.info(f"Backfill Origin {class_name} {card['Code']}{'' if apply else ' (dry-run)'}")
+                    if apply:
+                        self._make_request(
+                            f"classes/{class_name}/cards/{card['_id']}",
+                            method="PUT",
+                            data={"Origin": SYNC_ORIGIN}
                         )
+                found[class_name] = [card["Code"] for card in cards]
+            return found
+        except Exception as e:
+            logging.error(f"Errore durante il backfill dell'attributo Origin: {str(e)}")
+            raise
+
+    def close_relations(self, class_name: str, card_id: int, inactive_status: str, infra_id: int = None) -> None:
+        """
+        Chiude le relazioni InfrastructureCI e CIDependency di una card
+        
+        Args:
+            class_name: Classe della card
+            card_id: ID della card
+            inactive_status: Stato assegnato alle relazioni chiuse
+            infra_id: Se indicato, chiude solo le relazioni con questa infrastruttura
+        """
+        relations = self._make_request(f"classes/{class_name}/cards/{card_id}/relations")["data"]
+        for relation in relations:
+            if relation.get("_type") not in get_domains() or relation.get("Status") == inactive_status:
+                continue
+            if infra_id is not None and infra_id not in (relation.get("_sourceId"), relation.get("_destinationId")):
+                continue
+            self._make_request(
+                f"domains/{relation['_type']}/relations/{relation['_id']}",
+                method="PUT",
+                data={"Status": inactive_status}
+            )
+
+    def reconcile_stale_cards(
+        self,
+        max_stale_ratio: float = 0.2,
+        min_stale_count: int = 5,
+        inactive_status: str = "N"
+    ) -> Dict[str, List[str]]:
+        """
+        Riconcilia le card non più presenti nell'inventario Veeam
+        
+        Per ogni classe calcola la differenza tra i codici marcati dalla
+        sincronizzazione in CMDBuild e quelli sincronizzati nell'esecuzione
+        corrente. Le card create dal connettore vengono disattivate; gli asset
+        preesistenti che erano solo stati marcati (es. server usati come proxy)
+        perdono la marcatura Veeam e le relazioni con l'infrastruttura Veeam,
+        restando attivi. Le VM dei job recuperati in modo incompleto sono
+        escluse.
+        
+        Una classe viene saltata se l'inventario corrente non ne contiene
+        alcuna card, oppure se ha più di `min_stale_count` card obsolete che
+        superano la quota `max_stale_ratio`. Le altre classi vengono
+        comunque riconciliate, poi viene sollevato ReconcileError.
+        
+        Returns:
+            Codici riconciliati per classe
+        """
+        try:
+            logging.info("Inizio riconciliazione card obsolete")
+            
+            if not any(self.synced_codes.values()):
+                raise ReconcileError("Inventario Veeam vuoto, riconciliazione annullata")
+            
+            infra_id = self.get_infrastructure()["_id"]
+            reconciled = {}
+            skipped = []
+            for class_name in ("PhysicalServer", "VirtualServer", "Storage", "BackupJob"):
+                status_attr = get_status_attribute(class_name)
+                with span("reconcile.scan", class_name=class_name):
+                    candidates = {}
+                    for card in self.get_sync_cards(class_name, [status_attr]):
+                        if class_name == "VirtualServer" and card.get("BackupJob") in self.incomplete_jobs:
+                            continue
+                        owned = is_owned_by_sync(class_name, card)
+                        if owned and card.get(status_attr) == inactive_status:
+                            continue
+                        if owned or get_sync_tags(class_name, card):
+                            candidates[card["Code"]] = card
+                stale_codes = sorted(candidates.keys() - self.synced_codes[class_name])
                 
-                # Sincronizza VM del job
-                for vm in job.get("vms", []):
-                    vm_data = {
-                        "Code": vm["id"],
-                        "Hostname": vm.get("name", ""),
-                        "Status": "A",
-                        "LastBackup": vm.get("lastBackup", ""),
-                        "BackupJob": job["id"]
-                    }
-                    vm_card = self.create_or_update_card("VirtualServer", vm_data)
-                    
-                    # Crea relazione con l'infrastruttura
-                    self.create_relation(
-                        "InfrastructureCI",
-                        "Infrastructure",
-                        infra_id,
-                        "VirtualServer",
-                        vm_card["_id"]
+                if stale_codes and not self.synced_codes[class_name]:
+                    # Nessuna card della classe nell'inventario: probabile risposta Veeam parziale
+                    skipped.append(f"{class_name} ({len(stale_codes)} card, nessuna nell'inventario)")
+                    continue
+                if len(stale_codes) > min_stale_count and len(stale_codes) / len(candidates) > max_stale_ratio:
+                    skipped.append(
+                        f"{class_name} ({len(stale_codes)} card obsolete su {len(candidates)}, "
+                        f"soglia {max_stale_ratio:.0%})"
+                    )
+                    continue
+                
+                with span("reconcile.apply", class_name=class_name, count=len(stale_codes)):
+                    deactivated = untagged = 0
+                    for code in stale_codes:
+                        card = candidates[code]
+                        if is_owned_by_sync(class_name, card):
+                            self._make_request(
+                                f"classes/{class_name}/cards/{card['_id']}",
+                                method="PUT",
+                                data={status_attr: inactive_status}
+                            )
+                            self.close_relations(class_name, card["_id"], inactive_status)
+                            deactivated += 1
+                        else:
+                            # Asset preesistente: rimuove solo la marcatura Veeam
+                            self._make_request(
+                                f"classes/{class_name}/cards/{card['_id']}",
+                                method="PUT",
+                                data={attr: "" for attr in get_sync_tags(class_name, card)}
+                            )
+                            self.close_relations(class_name, card["_id"], inactive_status, infra_id)
+                            untagged += 1
+                reconciled[class_name] = stale_codes
+                if stale_codes:
+                    logging.info(
+                        f"Card {class_name} obsolete: {deactivated} disattivate, "
+                        f"{untagged} asset esistenti senza più marcatura Veeam"
                     )
             
-            logging.info("Sincronizzazione inventario Veeam completata con successo")
+            if skipped:
+                raise ReconcileError(f"Riconciliazione saltata per: {', '.join(skipped)}")
+            
+            logging.info("Riconciliazione card obsolete completata con successo")
+            return reconciled
             
         except Exception as e:
-            logging.error(f"Errore durante la sincronizzazione dell'inventario: {str(e)}")
+            logging.error(f"Errore durante la riconciliazione delle card obsolete: {str(e)}")
             raise
@@ -1,5 +1,8 @@
 """Schema delle classi CMDBuild per il connettore Veeam"""
 
+# Valore dell'attributo Origin per le card create dal connettore
+SYNC_ORIGIN = "VeeamConnector"
+
 CMDB_CLASSES = {
     "Infrastructure": {
         "key_attribute": "Code",
@@ -11,6 +14,10 @@ CMDB_CLASSES = {
     },
     "PhysicalServer": {  # Per i Veeam Proxy
         "key_attribute": "Code",
+        # Marcatura Veeam su asset che possono esistere indipendentemente dal connettore
+        "sync_tags": {"Type": "VeeamProxy"},
+        # Attributi compilati solo dall'asset management, mai dal connettore
+        "asset_attributes": ["Brand", "Model"],
         "attributes": {
             "Hostname": str,
             "Brand": str,
@@ -18,11 +25,14 @@ CMDB_CLASSES = {
             "OS": str,
             "OSVersion": str,
             "Status": str,
-            "Type": "VeeamProxy"  # Identificatore per i server Veeam
+            "Type": "VeeamProxy",  # Identificatore per i server Veeam
+            "Origin": str  # SYNC_ORIGIN se la card è stata creata dal connettore
         }
     },
     "VirtualServer": {  # Per le VM backuppate
         "key_attribute": "Code",
+        "sync_tags": {"Type": "VeeamProxy", "BackupJob": None},  # None: qualsiasi valore
+        "asset_attributes": ["OS", "OSVersion"],
         "attributes": {
             "Hostname": str,
             "OS": str,
@@ -30,29 +40,38 @@ CMDB_CLASSES = {
             "Status": str,
             "LastBackup": str,
             "BackupJob": str,  # Riferimento al job di backup
-            "Repository": str  # Riferimento al repository
+            "Repository": str,  # Riferimento al repository
+            "Origin": str
         }
     },
     "Storage": {  # Per i Repository Veeam
         "key_attribute": "Code",
+        "sync_tags": {"Type": "VeeamRepository"},
+        "owned_by_tag": True,  # Le card marcate sono create dal connettore
         "attributes": {
             "Name": str,
             "Type": "VeeamRepository",
             "Capacity": int,
             "FreeSpace": int,
-            "Status": str
+            "Status": str,
+            "Origin": str
         }
     },
     "BackupJob": {  # Nuova classe per i job di backup
         "key_attribute": "Code",
+        "status_attribute": "SyncStatus",  # Status contiene l'esito del job Veeam
+        "sync_tags": {"Type": "VeeamBackup"},
+        "owned_by_tag": True,
         "attributes": {
             "Name": str,
             "Type": str,
             "Status": str,
+            "SyncStatus": str,  # A/N: card attiva o disattivata dalla riconciliazione
             "LastRun": str,
             "NextRun": str,
             "Repository": str,  # Riferimento al repository
-            "Description": str
+            "Description": str,
+            "Origin": str
         }
     }
 }
@@ -78,6 +97,34 @@ def get_key_attribute(class_name):
     schema = get_class_schema(class_name)
     return schema.get("key_attribute")
 
+def get_status_attribute(class_name):
+    """Restituisce l'attributo che indica se la card è attiva"""
+    schema = get_class_schema(class_name)
+    return schema.get("status_attribute", "Status")
+
+def get_sync_tags(class_name, card=None):
+    """Restituisce la marcatura Veeam di una classe, o quella presente su una card"""
+    tags = get_class_schema(class_name).get("sync_tags", {})
+    if card is None:
+        return tags
+    return {
+        attr: card[attr]
+        for attr, value in tags.items()
+        if card.get(attr) and (value is None or card[attr] == value)
+    }
+
+def get_asset_attributes(class_name):
+    """Restituisce gli attributi che solo l'asset management compila"""
+    schema = get_class_schema(class_name)
+    return schema.get("asset_attributes", [])
+
+def is_owned_by_sync(class_name, card):
+    """Indica se una card è stata creata dal connettore (e non solo marcata)"""
+    if card.get("Origin") == SYNC_ORIGIN:
+        return True
+    schema = get_class_schema(class_name)
+    return schema.get("owned_by_tag", False) and bool(get_sync_tags(class_name, card))
+
 def get_attributes(class_name):
     """Restituisce gli attributi di una classe"""
     schema = get_class_schema(class_name)
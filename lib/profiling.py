@@ -0,0 +1,175 @@
+"""Profilazione opzionale della sincronizzazione
+
+Registra un albero di span (wall time e CPU time) e lo salva nel formato
+Trace Event JSON, apribile con Perfetto, chrome://tracing o speedscope.
+Quando la profilazione non è attiva `span()` restituisce un context manager
+vuoto, per cui l'instrumentazione nei client è a costo quasi nullo.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Any
+
+_NULL_SPAN = nullcontext()
+_active_profiler = None
+
+
+class Profiler:
+    """Raccoglie gli span di una esecuzione e li esporta come trace"""
+
+    def __init__(self, cprofile: bool = False):
+        self.events: List[Dict[str, Any]] = []
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self._thread_profiles: List[cProfile.Profile] = []
+        self._thread_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._logging_handlers: List[logging.Handler] = []
+
+    @contextmanager
+    def span(self, name: str, cat: str = "phase", **args):
+        """Misura un blocco di codice e lo registra come evento completo"""
+        thread = threading.current_thread()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall_end = time.perf_counter()
+            cpu_end = time.thread_time()
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": (wall_start - self.origin) * 1e6,
+                "dur": (wall_end - wall_start) * 1e6,
+                "pid": self.pid,
+                "tid": thread.ident,
+                "args": {
+                    "cpu_ms": round((cpu_end - cpu_start) * 1e3, 3),
+                    **args
+                }
+            }
+            with self._lock:
+                self._thread_names.setdefault(thread.ident, thread.name)
+                self.events.append(event)
+
+    def _instrument_logging(self) -> None:
+        """Misura il tempo speso negli handler di logging del logger root"""
+        for handler in logging.getLogger().handlers:
+            original_handle = handler.handle
+
+            def timed_handle(record, _original=original_handle):
+                with self.span("logging", cat="logging"):
+                    return _original(record)
+
+            handler.handle = timed_handle
+            self._logging_handlers.append(handler)
+
+    def _restore_logging(self) -> None:
+        """Rimuove l'instrumentazione dagli handler di logging"""
+        for handler in self._logging_handlers:
+            del handler.handle
+        self._logging_handlers = []
+
+    @contextmanager
+    def profile_thread(self):
+        """Attiva cProfile nel thread corrente e lo unisce al dump finale"""
+        # Da Python 3.12 cProfile usa sys.monitoring: il profiler del thread
+        # principale copre già tutti i thread e ne è ammesso uno solo attivo
+        if not self.cprofile or sys.version_info >= (3, 12):
+            yield
+            return
+        thread_profile = cProfile.Profile()
+        thread_profile.enable()
+        try:
+            yield
+        finally:
+            thread_profile.disable()
+            with self._lock:
+                self._thread_profiles.append(thread_profile)
+
+    def start(self) -> None:
+        """Attiva la profilazione"""
+        global _active_profiler
+        _active_profiler = self
+        self._instrument_logging()
+        if self.cprofile:
+            # Fino a Python 3.11 cProfile campiona solo il thread che lo attiva:
+            # gli altri thread usano profile_thread()
+            self.cprofile.enable()
+
+    def stop(self) -> None:
+        """Disattiva la profilazione"""
+        global _active_profiler
+        if self.cprofile:
+            self.cprofile.disable()
+        self._restore_logging()
+        _active_profiler = None
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Totali di wall time e CPU time per categoria di span"""
+        totals: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            entry = totals.setdefault(event["cat"], {"count": 0, "wall_ms": 0.0, "cpu_ms": 0.0})
+            entry["count"] += 1
+            entry["wall_ms"] += event["dur"] / 1e3
+            entry["cpu_ms"] += event["args"]["cpu_ms"]
+        return totals
+
+    def write(self, trace_file: str) -> None:
+        """Scrive il trace (ed eventualmente le statistiche cProfile) su file"""
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": tid,
+                "args": {"name": name}
+            }
+            for tid, name in self._thread_names.items()
+        ]
+        trace_dir = os.path.dirname(trace_file)
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+        logging.info(f"Trace di profilazione salvato in {trace_file}")
+
+        if self.cprofile:
+            stats_file = os.path.splitext(trace_file)[0] + ".pstats"
+            stats = pstats.Stats(self.cprofile)
+            for thread_profile in self._thread_profiles:
+                stats.add(thread_profile)
+            stats.dump_stats(stats_file)
+            logging.info(f"Statistiche cProfile salvate in {stats_file}")
+
+        for cat, entry in sorted(self.summary().items()):
+            logging.info(
+                f"Profilo {cat}: {entry['count']} span, "
+                f"wall {entry['wall_ms']:.1f} ms, CPU {entry['cpu_ms']:.1f} ms"
+            )
+
+
+def profile_thread():
+    """Context manager che estende cProfile al thread corrente, se attivo"""
+    profiler = _active_profiler
+    if profiler is None:
+        return _NULL_SPAN
+    return profiler.profile_thread()
+
+
+def span(name: str, cat: str = "phase", **args):
+    """Context manager che registra uno span se la profilazione è attiva"""
+    profiler = _active_profiler
+    if profiler is None:
+        return _NULL_SPAN
+    return profiler.span(name, cat, **args)
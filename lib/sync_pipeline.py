@@ -0,0 +1,114 @@
+import queue
+import logging
+import threading
+from typing import Any, Optional, Tuple
+from .veeam_client import VeeamClient
+from .cmdb_client import CMDBuildClient
+from .profiling import span, profile_thread
+
+# Marcatori scambiati sulla coda tra raccolta e scrittura
+_END = object()
+_ERROR = object()
+
+
+class SyncPipeline:
+    """Pipeline produttore/consumatore tra raccolta Veeam e scrittura su CMDBuild
+
+    Un thread dedicato raccoglie l'inventario da Veeam e inserisce ogni proxy,
+    repository e job (con le sue VM) in una coda limitata appena recuperato;
+    il thread chiamante li scrive su CMDBuild man mano. La coda piena blocca
+    il produttore, per cui in memoria restano al massimo `queue_size` elementi.
+    """
+
+    def __init__(self, veeam_client: VeeamClient, cmdb_client: CMDBuildClient, queue_size: int = 10):
+        self.veeam_client = veeam_client
+        self.cmdb_client = cmdb_client
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.stop_event = threading.Event()
+
+    def _put(self, item: Tuple[Any, Any]) -> bool:
+        """Inserisce un elemento nella coda, rinunciando se il consumatore si è fermato"""
+        with span("pipeline.put", cat="queue"):
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+    def _produce(self) -> None:
+        """Raccoglie l'inventario Veeam e lo inserisce nella coda"""
+        # Qualsiasi uscita non prevista (anche BaseException) arriva al consumatore come errore
+        outcome = (_ERROR, RuntimeError("Raccolta dell'inventario Veeam interrotta"))
+        try:
+            # La raccolta gira in un thread dedicato: cProfile va attivato qui
+            with profile_thread():
+                # Proxy e repository precedono i job, che referenziano i repository
+                for proxy in self.veeam_client.get_proxies():
+                    if not self._put(("proxy", proxy)):
+                        return
+                for repo in self.veeam_client.get_repositories():
+                    if not self._put(("repository", repo)):
+                        return
+                for job in self.veeam_client.iter_backup_jobs():
+                    if not self._put(("backup_job", job)):
+                        return
+            outcome = (_END, None)
+        except Exception as e:
+            logging.error(f"Errore durante la raccolta dell'inventario Veeam: {str(e)}")
+            outcome = (_ERROR, e)
+        finally:
+            self._put(outcome)
+
+    def _get(self, producer: threading.Thread) -> Tuple[Any, Any]:
+        """Preleva un elemento dalla coda, fallendo se il produttore è terminato senza esito"""
+        with span("pipeline.get", cat="queue"):
+            while True:
+                try:
+                    return self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    if not producer.is_alive() and self.queue.empty():
+                        raise RuntimeError("Thread di raccolta Veeam terminato senza completare l'inventario")
+
+    def _consume(self, infra_id: int, producer: threading.Thread) -> Optional[Exception]:
+        """Scrive su CMDBuild gli elementi ricevuti dalla coda"""
+        writers = {
+            "proxy": self.cmdb_client.sync_proxy,
+            "repository": self.cmdb_client.sync_repository,
+            "backup_job": self.cmdb_client.sync_backup_job
+        }
+        while True:
+            kind, payload = self._get(producer)
+            if kind is _END:
+                return None
+            if kind is _ERROR:
+                return payload
+            with span("pipeline.write", kind=kind):
+                writers[kind](infra_id, payload)
+
+    def run(self) -> None:
+        """Esegue la sincronizzazione sovrapponendo raccolta e scrittura"""
+        logging.info("Inizio sincronizzazione inventario Veeam in modalità pipeline")
+        producer = threading.Thread(target=self._produce, name="veeam-collector", daemon=True)
+        try:
+            self.cmdb_client.reset_sync_tracking()
+
+            # Recupera o crea l'infrastruttura prima di avviare la raccolta
+            infrastructure = self.cmdb_client.get_infrastructure()
+            infra_id = infrastructure["_id"]
+
+            producer.start()
+            error = self._consume(infra_id, producer)
+            if error is not None:
+                raise error
+
+            logging.info("Sincronizzazione inventario Veeam in modalità pipeline completata con successo")
+        except Exception as e:
+            logging.error(f"Errore durante la sincronizzazione in modalità pipeline: {str(e)}")
+            raise
+        finally:
+            # Sblocca il produttore se la scrittura si è interrotta
+            self.stop_event.set()
+            if producer.is_alive():
+                producer.join()
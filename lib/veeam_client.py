@@ -1,8 +1,9 @@
 import requests
 import logging
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator
 from datetime import datetime
 from urllib3.exceptions import InsecureRequestWarning
+from .profiling import span
 
 # Disabilita warning per SSL non verificato
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
@@ -44,14 +45,16 @@ class VeeamClient:
         url = f"{self.base_url}/api/v1/{endpoint}"
         
         try:
-            response = self.session.request(
-                method=method,
-                url=url,
-                params=params,
-                verify=self.verify_ssl
-            )
+            with span("veeam.request", cat="network", method=method, endpoint=endpoint):
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    params=params,
+                    verify=self.verify_ssl
+                )
             response.raise_for_status()
-            return response.json()
+            with span("veeam.json", cat="json", endpoint=endpoint):
+                return response.json()
         except requests.exceptions.RequestException as e:
             if response.status_code == 401:
                 # Token scaduto, riprova con nuovo token
@@ -64,11 +67,12 @@ class VeeamClient:
         """Ottiene la lista dei proxy configurati"""
         logging.info("Recupero lista proxy Veeam")
         try:
-            proxies = self._make_request("proxies")
-            for proxy in proxies:
-                # Arricchisce i dati del proxy con informazioni dettagliate
-                details = self._make_request(f"proxies/{proxy['id']}")
-                proxy.update(details)
+            with span("collect.proxies"):
+                proxies = self._make_request("proxies")
+                for proxy in proxies:
+                    # Arricchisce i dati del proxy con informazioni dettagliate
+                    details = self._make_request(f"proxies/{proxy['id']}")
+                    proxy.update(details)
             return proxies
         except Exception as e:
             logging.error(f"Errore nel recupero dei proxy: {str(e)}")
@@ -78,11 +82,12 @@ class VeeamClient:
         """Ottiene la lista dei repository"""
         logging.info("Recupero lista repository Veeam")
         try:
-            repos = self._make_request("repositories")
-            for repo in repos:
-                # Arricchisce i dati del repository con informazioni dettagliate
-                details = self._make_request(f"repositories/{repo['id']}/info")
-                repo.update(details)
+            with span("collect.repositories"):
+                repos = self._make_request("repositories")
+                for repo in repos:
+                    # Arricchisce i dati del repository con informazioni dettagliate
+                    details = self._make_request(f"repositories/{repo['id']}/info")
+                    repo.update(details)
             return repos
         except Exception as e:
             logging.error(f"Errore nel recupero dei repository: {str(e)}")
@@ -90,22 +95,41 @@ class VeeamClient:
 
     def get_backup_jobs(self) -> List[Dict]:
         """Ottiene la lista dei backup jobs"""
+        return list(self.iter_backup_jobs())
+
+    def iter_backup_jobs(self) -> Iterator[Dict]:
+        """Restituisce i backup jobs uno alla volta, ognuno con le sue VM, appena recuperati"""
         logging.info("Recupero lista backup jobs Veeam")
         try:
-            jobs = self._make_request("jobs")
+            with span("collect.backup_jobs"):
+                jobs = self._make_request("jobs")
             for job in jobs:
-                # Arricchisce i dati del job con informazioni dettagliate
-                details = self._make_request(f"jobs/{job['id']}")
-                job.update(details)
-                # Aggiunge le VM associate al job
-                job['vms'] = self.get_vms_in_backup(job['id'])
-            return jobs
+                # Lo span si chiude prima dello yield per non includere il tempo del consumatore
+                with span("collect.backup_job", job=job['id']):
+                    # Arricchisce i dati del job con informazioni dettagliate
+                    details = self._make_request(f"jobs/{job['id']}")
+                    job.update(details)
+                    # Aggiunge le VM associate al job
+                    try:
+                        job['vms'] = self.get_vms_in_backup(job['id'], strict=True)
+                    except Exception:
+                        # Job segnalato come incompleto: la riconciliazione non
+                        # considera obsolete le sue VM
+                        job['vms'] = []
+                        job['vmsIncomplete'] = True
+                yield job
         except Exception as e:
             logging.error(f"Errore nel recupero dei backup jobs: {str(e)}")
             raise
 
-    def get_vms_in_backup(self, job_id: str) -> List[Dict]:
-        """Ottiene la lista delle VM incluse in un backup"""
+    def get_vms_in_backup(self, job_id: str, strict: bool = False) -> List[Dict]:
+        """
+        Ottiene la lista delle VM incluse in un backup
+        
+        Args:
+            job_id: ID del job
+            strict: Se True propaga gli errori invece di restituire una lista vuota
+        """
         logging.info(f"Recupero VM del job {job_id}")
         try:
             vms = self._make_request(f"jobs/{job_id}/objects")
@@ -116,17 +140,20 @@ class VeeamClient:
             return vms
         except Exception as e:
             logging.error(f"Errore nel recupero delle VM del job {job_id}: {str(e)}")
+            if strict:
+                raise
             return []
 
     def get_full_inventory(self) -> Dict[str, List[Dict]]:
         """Ottiene l'inventario completo di tutte le risorse"""
         logging.info("Inizio recupero inventario completo Veeam")
         try:
-            inventory = {
-                "proxies": self.get_proxies(),
-                "repositories": self.get_repositories(),
-                "backup_jobs": self.get_backup_jobs()
-            }
+            with span("collect.inventory"):
+                inventory = {
+                    "proxies": self.get_proxies(),
+                    "repositories": self.get_repositories(),
+                    "backup_jobs": self.get_backup_jobs()
+                }
             
             logging.info("Inventario Veeam recuperato con successo")
             return inventory